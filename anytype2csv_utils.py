@@ -1,15 +1,25 @@
+import csv
 import os
 import zipfile
-import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-
-import pandas as pd
+from functools import lru_cache
 
 from google.protobuf import text_format  # Or use binary parsing
+from google.protobuf.internal import api_implementation
 
 from snapshot_pb2 import SnapshotWithType
+from snapshot_lite_pb2 import SnapshotWithTypeLite
 from models_pb2 import RelationFormat
 
+def _extract_members(pbfile, pbdir, members):
+    """Extracts some members of a zip archive, through a file handle of its own."""
+    if not members:
+        return
+    with zipfile.ZipFile(pbfile, mode="r") as archive:
+        for member in members:
+            archive.extract(member, pbdir)
+
 def extract_archive(pbfile, pbdir, debug=False):
     """
     Extracts the provided zip archive containing protobuf export files to a target directory.
@@ -27,7 +37,26 @@ def extract_archive(pbfile, pbdir, debug=False):
     with zipfile.ZipFile(pbfile, mode="r") as archive:
         if debug:
             archive.printdir()
-        archive.extractall(pbdir)
+        # Extract directories and one file per directory first, so that the
+        # workers below never race on creating the same directory.
+        seen = set()
+        first = []
+        rest = []
+        for member in archive.infolist():
+            parent = member.filename.rpartition('/')[0]
+            if member.is_dir() or parent not in seen:
+                seen.add(parent)
+                first.append(member)
+            else:
+                rest.append(member)
+        archive.extractall(pbdir, members=first)
+
+    workers = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_extract_members, pbfile, pbdir, rest[i::workers])
+                   for i in range(workers)]
+        for future in futures:
+            future.result()
 
 def ensure_directories(pbdir):
     """
@@ -41,21 +70,24 @@ def ensure_directories(pbdir):
     """
     csvdir = os.path.join(pbdir, 'csv')
     datadir = os.path.join(pbdir, 'data')
-    os.makedirs(csvdir, exist_ok=True)
-    os.makedirs(datadir, exist_ok=True)
+    # Debug dumps are written flat into datadir, no other directory is needed.
+    for directory in (csvdir, datadir):
+        os.makedirs(directory, exist_ok=True)
     return csvdir, datadir
 
-def load_single_message_from_file(filepath):
+def parse_message_file(filepath, message_class=None):
     """
-    Loads a protobuf message from a binary file.
+    Parses a protobuf message from a binary file, without caching.
 
     Args:
         filepath (str): Path to the protobuf file.
+        message_class (type, optional): Message class to parse into. Defaults to SnapshotWithType.
 
     Returns:
-        SnapshotWithType | None: The parsed message, or None if reading/parsing failed.
+        Message | None: An instance of message_class (SnapshotWithType by default),
+            or None if reading/parsing failed.
     """
-    message = SnapshotWithType()
+    message = (message_class or SnapshotWithType)()
     try:
         with open(filepath, "rb") as f:
             message.ParseFromString(f.read())
@@ -66,7 +98,59 @@ def load_single_message_from_file(filepath):
         print(f"Error parsing protobuf message: {e}")
         return None
 
-def read_rel_option(option, pbdir, unknown_options):
+@lru_cache(maxsize=None)
+def load_single_message_from_file(filepath):
+    """
+    Loads a protobuf message from a binary file.
+
+    Results are cached by path so that each file is parsed once per export:
+    returned messages are shared and must be treated as read-only.
+
+    Args:
+        filepath (str): Path to the protobuf file.
+
+    Returns:
+        SnapshotWithType | None: The parsed message, or None if reading/parsing failed.
+    """
+    return parse_message_file(filepath)
+
+def load_name_and_key_from_file(filepath):
+    """
+    Reads the name and key of a snapshot, without keeping the parsed message around.
+
+    The file is parsed as a SnapshotWithTypeLite (snapshot_lite.proto), so the
+    decoder skips blocks and every other field instead of building them.
+
+    Args:
+        filepath (str): Path to the protobuf file.
+
+    Returns:
+        tuple[str, str] | None: The snapshot name and key, or None if reading/parsing failed.
+    """
+    msg = parse_message_file(filepath, SnapshotWithTypeLite)
+    if msg is None:
+        return None
+    return msg.snapshot.data.details.fields['name'].string_value, msg.snapshot.data.key
+
+def load_messages_from_files(filepaths, loader=None):
+    """
+    Loads protobuf messages from several binary files using a thread pool.
+
+    Args:
+        filepaths (list[str]): Paths to the protobuf files.
+        loader (Callable, optional): Function applied to each path. Defaults to
+            load_single_message_from_file.
+
+    Returns:
+        list: The loader results, in the order of filepaths (None where loading failed).
+    """
+    if loader is None:
+        loader = load_single_message_from_file
+    # Loading waits on small file reads as much as on parsing: use more threads than cores.
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        return list(executor.map(loader, filepaths))
+
+def read_rel_option(option, pbdir, unknown_options, my_cache=None):
     """
     Resolves a relation option to its human-readable name by searching in several directories.
 
@@ -74,13 +158,20 @@ def read_rel_option(option, pbdir, unknown_options):
         option (str): The key of the relation option.
         pbdir (str): Path to the workspace directory.
         unknown_options (dict): Dict to track unknown options.
-        load_single_message_from_file (Callable): Function to load message from file.
+        my_cache (dict, optional): Cache of relation/type mappings. When it holds an
+            'options' index, it is used instead of reading files from disk.
 
     Returns:
         str: The resolved option name, or an empty string if not found.
     """
     if option == "":
         return ""
+    if my_cache is not None and 'options' in my_cache:
+        name = my_cache['options'].get(option)
+        if name is None:
+            unknown_options[option] = unknown_options.get(option, 0) + 1
+            return ""
+        return name
     msg = None
     search_paths = [
         os.path.join(pbdir, "relationsOptions", f"{option}.pb"),
@@ -97,12 +188,66 @@ def read_rel_option(option, pbdir, unknown_options):
         return ""
     return msg.snapshot.data.details.fields['name'].string_value
 
-def read_data(proto_data, field, pbdir, unknown_types, unknown_options, my_cache):
+def _read_string(fld, pbdir, unknown_options, my_cache):
+    """Reads a text-like field (text, file, url, email, phone, emoji, relations)."""
+    return fld.string_value
+
+def _read_number(fld, pbdir, unknown_options, my_cache):
+    """Reads a number field."""
+    return fld.number_value
+
+# Many objects share the same dates: convert each timestamp once.
+_datetime_from_timestamp = lru_cache(maxsize=4096)(datetime.fromtimestamp)
+
+def _read_date(fld, pbdir, unknown_options, my_cache):
+    """Reads a date field stored as a timestamp."""
+    return _datetime_from_timestamp(fld.number_value)
+
+def _read_checkbox(fld, pbdir, unknown_options, my_cache):
+    """Reads a checkbox field."""
+    return fld.bool_value
+
+def _read_options(fld, pbdir, unknown_options, my_cache):
+    """Reads a status or tag field as a comma separated list of option names."""
+    names = [read_rel_option(i.string_value, pbdir, unknown_options, my_cache)
+             for i in fld.list_value.values]
+    # Unresolved options are left out rather than leaving empty slots in the list.
+    return ', '.join(name for name in names if name)
+
+def _read_object(fld, pbdir, unknown_options, my_cache):
+    """Reads an object field, either a single object or a list of objects."""
+    if fld.list_value.values:
+        return _read_options(fld, pbdir, unknown_options, my_cache)
+    return read_rel_option(fld.string_value, pbdir, unknown_options, my_cache)
+
+# Reader for each supported relation format, see read_data.
+_FORMAT_HANDLERS = {
+    RelationFormat.longtext: _read_string,
+    RelationFormat.shorttext: _read_string,
+    RelationFormat.number: _read_number,
+    RelationFormat.status: _read_options,
+    RelationFormat.tag: _read_options,
+    RelationFormat.object: _read_object,
+    RelationFormat.date: _read_date,
+    RelationFormat.file: _read_string,
+    RelationFormat.checkbox: _read_checkbox,
+    RelationFormat.url: _read_string,
+    RelationFormat.email: _read_string,
+    RelationFormat.phone: _read_string,
+    RelationFormat.emoji: _read_string,
+    RelationFormat.relations: _read_string,
+}
+# Text-like formats, the most common ones, are read inline by read_data.
+_STRING_FORMATS = frozenset(f for f, handler in _FORMAT_HANDLERS.items() if handler is _read_string)
+
+def read_data(fld, fld_format, field, pbdir, unknown_types, unknown_options, my_cache):
     """
-    Reads and interprets the value of a specific field from a protobuf data object.
+    Interprets the value of a specific field from a protobuf data object.
 
     Args:
-        proto_data: The protobuf data object.
+        fld: The protobuf value of the field.
+        fld_format (int | None): The relation format of the field, or None if the
+            message has no relation link for it.
         field (str): The protobuf field name.
         pbdir (str): Path to the workspace directory.
         unknown_types (dict): Dict to track unknown field types.
@@ -112,62 +257,16 @@ def read_data(proto_data, field, pbdir, unknown_types, unknown_options, my_cache
     Returns:
         Any: The interpreted value of the field, type depends on the relation format.
     """
-    found = False
-    fld = proto_data.snapshot.data.details.fields[field]
-    fld_format = None
-
-    for i in proto_data.snapshot.data.relationLinks:
-        if i.key == field:
-            fld_format = i.format
-            found = True
-            break
-
-    if not found:
+    if fld_format is None:
         return ""
+    if fld_format in _STRING_FORMATS:
+        return fld.string_value
 
-    match fld_format:
-        case RelationFormat.longtext | RelationFormat.shorttext:
-            return fld.string_value
-        case RelationFormat.number:
-            return fld.number_value
-        case RelationFormat.status | RelationFormat.tag:
-            ret = ""
-            for i in fld.list_value.values:
-                if ret != "":
-                    ret += ', ' + read_rel_option(i.string_value, pbdir, unknown_options)
-                else:
-                    ret = read_rel_option(i.string_value, pbdir, unknown_options)
-            return ret
-        case RelationFormat.object:
-            ret = ""
-            if fld.list_value.values:
-                for i in fld.list_value.values:
-                    if ret != "":
-                        ret += ', ' + read_rel_option(i.string_value, pbdir, unknown_options)
-                    else:
-                        ret = read_rel_option(i.string_value, pbdir, unknown_options)
-            else:
-                ret = read_rel_option(fld.string_value, pbdir, unknown_options)
-            return ret
-        case RelationFormat.date:
-            return datetime.fromtimestamp(fld.number_value)
-        case RelationFormat.file:
-            return fld.string_value
-        case RelationFormat.checkbox:
-            return fld.bool_value
-        case RelationFormat.url:
-            return fld.string_value
-        case RelationFormat.email:
-            return fld.string_value
-        case RelationFormat.phone:
-            return fld.string_value
-        case RelationFormat.emoji:
-            return fld.string_value
-        case RelationFormat.relations:
-            return fld.string_value
-        case _:
-            unknown_types[field] = unknown_types.get(field, 0) + 1
-            return ""
+    handler = _FORMAT_HANDLERS.get(fld_format)
+    if handler is None:
+        unknown_types[field] = unknown_types.get(field, 0) + 1
+        return ""
+    return handler(fld, pbdir, unknown_options, my_cache)
 
 def proto_to_csv(proto_data_list, csv_file_path, types_to_extract, fields_to_extract, my_cache, pbdir, unknown_types, unknown_options):
     """
@@ -184,119 +283,196 @@ def proto_to_csv(proto_data_list, csv_file_path, types_to_extract, fields_to_ext
         unknown_options (dict): Dict to track unknown options.
     """
     delimiter = '|'
-    df = pd.DataFrame()
-    if 'Object type' in my_cache['relations'].keys():
+    if 'Object type' in my_cache['relations']:
         objtyperel = my_cache['relations']['Object type']
     else:
         print('Couldn\'t find Object type information - aborting specific type extraction.')
         return
 
+    revrel = my_cache['revrel']
+    types_set = None if types_to_extract is None else set(types_to_extract)
+    # Raw field keys exported under the requested names (a key is exported as revrel.get(key, key)),
+    # so that only those are looked up in each message.
+    wanted_keys = None
+    if fields_to_extract is not None:
+        wanted_keys = list(dict.fromkeys(
+            k for name in fields_to_extract for k in (my_cache['relations'].get(name), name)
+            if k is not None and revrel.get(k, k) == name))
+
+    # First pass: select messages and fields, which gives the CSV header.
+    selected = []
+    columns = set()
     for proto_data in proto_data_list:
-        if types_to_extract is not None:
-            if read_data(proto_data, objtyperel, pbdir, unknown_types, unknown_options, my_cache) not in types_to_extract:
+        data = proto_data.snapshot.data
+        fld = data.details.fields
+        # Built in reverse so that, like a forward scan, the first link of a key wins.
+        fmt_map = {link.key: link.format for link in reversed(data.relationLinks)}
+
+        if types_set is not None:
+            objtype = read_data(fld[objtyperel], fmt_map.get(objtyperel), objtyperel,
+                                pbdir, unknown_types, unknown_options, my_cache)
+            if objtype not in types_set:
                 continue
 
-        row = {}
-        fld = proto_data.snapshot.data.details.fields
+        if wanted_keys is None:
+            candidates = fld.items()
+        else:
+            candidates = [(i, fld[i]) for i in wanted_keys if i in fld]
+        fields = []
+        for i, value in candidates:
+            key = revrel.get(i, i)
+            fields.append((i, key, value, fmt_map.get(i)))
+            columns.add(key)
+        selected.append(fields)
+
+    # Second pass: values are read and written row by row.
+    with open(csv_file_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=sorted(columns), restval='',
+                                delimiter=delimiter, lineterminator=os.linesep)
+        writer.writeheader()
+        for fields in selected:
+            writer.writerow({key: read_data(value, fld_format, i,
+                                            pbdir, unknown_types, unknown_options, my_cache)
+                             for i, key, value, fld_format in fields})
+
+def list_pb_files(objdir):
+    """
+    Lists the protobuf (.pb) files of a directory, sorted by name.
 
-        for i in fld.keys():
-            key = my_cache['revrel'].get(i, i)
-            if fields_to_extract is not None and key not in fields_to_extract:
-                continue
-            row[key] = read_data(proto_data, i, pbdir, unknown_types, unknown_options, my_cache)
-        rowdf = pd.DataFrame.from_dict([row])
-        df = pd.concat([df, rowdf], sort=True)
-    #df.sort_values('Creation date', inplace=True)
-    df.to_csv(csv_file_path, sep=delimiter)
+    Args:
+        objdir (str): Directory to scan for protobuf files.
+
+    Returns:
+        list[str]: Paths of the protobuf files, empty if the directory does not exist.
+    """
+    try:
+        with os.scandir(objdir) as entries:
+            return sorted(e.path for e in entries if e.is_file() and e.name.endswith('.pb'))
+    except FileNotFoundError:
+        return []
 
-def dump_data(objdir, regex, datadir, debug):
+def index_pb_files(pbdir):
     """
-    Loads all protobuf messages from a directory matching a filename regex.
+    Lists once the protobuf files of every workspace subdirectory used for the export.
 
     Args:
-        objdir (str): Directory to scan for protobuf files.
-        regex (re.Pattern): Compiled regex pattern for file matching.
+        pbdir (str): Path to the workspace directory.
+
+    Returns:
+        dict: Sorted protobuf file paths for 'types', 'relations', 'objects' and 'relationsOptions'.
+    """
+    return {obj: list_pb_files(os.path.join(pbdir, obj))
+            for obj in ['types', 'relations', 'objects', 'relationsOptions']}
+
+def dump_data(pbfiles, datadir, debug):
+    """
+    Loads protobuf messages from a list of files.
+
+    Args:
+        pbfiles (list[str]): Paths of the protobuf files to load.
         datadir (str): Directory for debug output (optional).
         debug (bool): If True, writes debug info to files.
-        load_single_message_from_file (Callable): Function to load message from file.
 
     Returns:
         list: List of loaded protobuf messages.
     """
     m = []
-    for root, dirs, files in os.walk(objdir):
-        for file in files:
-            if regex.match(file):
-                msg = load_single_message_from_file(os.path.join(objdir, file))
-                if debug:
-                    with open(os.path.join(datadir, f"{file}.data"), "w") as f:
-                        f.write(str(msg))
-                m.append(msg)
+    for filepath in pbfiles:
+        msg = load_single_message_from_file(filepath)
+        if debug:
+            with open(os.path.join(datadir, f"{os.path.basename(filepath)}.data"), "w", encoding="utf-8") as f:
+                if msg is not None:
+                    text_format.PrintMessage(msg, f, as_utf8=True)
+                else:
+                    f.write(str(msg))
+        m.append(msg)
     return m
 
-def build_cache(pbdir, regex):
+def build_cache(pbdir, pb_index=None):
     """
-    Builds a cache of mappings for types, relations, and objects in the workspace.
+    Builds a cache of mappings for types, relations, objects and relation options in the workspace.
 
     Args:
         pbdir (str): Path to the workspace directory.
-        regex (re.Pattern): Compiled regex pattern for file matching.
-        load_single_message_from_file (Callable): Function to load message from file.
+        pb_index (dict, optional): Protobuf files per subdirectory, as returned by
+            index_pb_files. Computed from pbdir if not provided.
 
     Returns:
-        dict: Cache dictionary containing mappings for 'types', 'relations', 'objects', and 'revrel'.
+        tuple[dict, list]: Cache dictionary containing mappings for 'types', 'relations', 'objects',
+            'revrel' and 'options' (option id to name, as resolved by read_rel_option), and the
+            loaded object messages in file order.
     """
+    if pb_index is None:
+        pb_index = index_pb_files(pbdir)
     my_cache = {}
-    for obj in ['types', 'relations', 'objects']:
+    names = {}
+    object_messages = []
+    for obj in ['types', 'relations', 'objects', 'relationsOptions']:
         dict1 = {}
         dict2 = {}
-        objdir = os.path.join(pbdir, obj)
-        for root, dirs, files in os.walk(objdir):
-            dirs.sort()
-            for file in sorted(files):
-                if regex.match(file):
-                    msg = load_single_message_from_file(os.path.join(objdir, file))
-                    match obj:
-                        case 'types' | 'objects':
-                            dict1[file[0:-3]] = msg.snapshot.data.details.fields['name'].string_value
-                        case 'relations':
-                            # Strangely enough, relations with the same name can exist...
-                            i=1
-                            name0 = msg.snapshot.data.details.fields['name'].string_value
-                            name = name0
-                            while name in dict1:
-                                name = name0 + str(i)
-                                i+=1
-                            dict1[name] = msg.snapshot.data.key
-                            dict2[msg.snapshot.data.key] = name
+        names[obj] = {}
+        pbfiles = pb_index[obj]
+        if obj == 'objects':
+            # Object messages are kept: they are the ones exported to CSV.
+            messages = load_messages_from_files(pbfiles)
+            object_messages = [msg for msg in messages if msg is not None]
+            entries = [None if msg is None else
+                       (msg.snapshot.data.details.fields['name'].string_value, msg.snapshot.data.key)
+                       for msg in messages]
+        else:
+            entries = load_messages_from_files(pbfiles, load_name_and_key_from_file)
+        # Loading is parallel, mapping stays sequential so name disambiguation is deterministic.
+        for filepath, entry in zip(pbfiles, entries):
+            if entry is None:
+                continue
+            file = os.path.basename(filepath)
+            name0, key = entry
+            names[obj][file[0:-3]] = name0
+            match obj:
+                case 'types' | 'objects':
+                    dict1[file[0:-3]] = name0
+                case 'relations':
+                    # Strangely enough, relations with the same name can exist...
+                    i=1
+                    name = name0
+                    while name in dict1:
+                        name = name0 + str(i)
+                        i+=1
+                    dict1[name] = key
+                    dict2[key] = name
         match obj:
             case 'types' | 'objects':
                 my_cache[obj] = dict1
             case 'relations':
                 my_cache[obj] = dict1
                 my_cache['revrel'] = dict2
-    return my_cache
+
+    # Same search order as read_rel_option on disk: the first directory holding the id wins.
+    my_cache['options'] = {}
+    for obj in ['relationsOptions', 'objects', 'relations', 'types']:
+        for option, name in names[obj].items():
+            my_cache['options'].setdefault(option, name)
+    return my_cache, object_messages
 
 def build_csv(pbdir, dump_types, dump_fields, debug):
     unknown_options = {}
     unknown_types = {}
 
     csvdir, datadir = ensure_directories(pbdir)
+    # Files, or the time zone used for dates, may have changed since a previous
+    # export run in this process.
+    load_single_message_from_file.cache_clear()
+    _datetime_from_timestamp.cache_clear()
 
-    regex = re.compile(r'(.*pb$)')
-
-    my_cache = build_cache(pbdir, regex)
+    # protobuf>=4.21 picks the native upb decoder by default; the pure-Python
+    # one is much slower at parsing thousands of snapshots.
+    if debug:
+        print(f"Protobuf implementation: {api_implementation.Type()}")
+    if api_implementation.Type() == 'python':
+        print('Warning: pure-Python protobuf in use, parsing will be slow.')
 
-    # Gather proto messages to export
-    objdir = os.path.join(pbdir, 'objects')
-    messages = []
-    for root, dirs, files in os.walk(objdir):
-        dirs.sort()
-        for file in sorted(files):
-            if regex.match(file):
-                msg = load_single_message_from_file(os.path.join(objdir, file))
-                if msg is not None:
-                    messages.append(msg)
+    pb_index = index_pb_files(pbdir)
+    my_cache, messages = build_cache(pbdir, pb_index)
 
     outtime = datetime.now().strftime("%Y%m%d-%H%M%S")
     outcsv = os.path.join(csvdir, f'anytype2csv-output-{outtime}.csv')
@@ -305,16 +481,15 @@ def build_csv(pbdir, dump_types, dump_fields, debug):
 
     if debug:
         for domain in ['types', 'relations', 'objects']:
-            messages = []
-            objdir = os.path.join(pbdir, domain)
-            messages = dump_data(objdir, regex, datadir, debug)
+            messages = dump_data(pb_index[domain], datadir, debug)
 
         print("Unknown types:")
-        for ut in unknown_types.keys():
-            print(ut, unknown_types[ut])
+        for ut, count in unknown_types.items():
+            print(ut, count)
 
         print("Unknown options:")
-        for uo in unknown_options.keys():
-            print(uo, unknown_options[uo])
+        for uo, count in unknown_options.items():
+            print(uo, count)
 
+    load_single_message_from_file.cache_clear()
     return outcsv
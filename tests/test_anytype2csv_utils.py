@@ -1,7 +1,6 @@
 import os
 import tempfile
 import pytest
-import re
 import time
 from datetime import datetime
 from distutils import dir_util
@@ -61,6 +60,24 @@ def test_extract_archive(tmp_path):
     anytype2csv_utils.extract_archive(str(zip_path), str(extract_dir))
     assert (extract_dir / "test.txt").exists()
 
+def test_extract_archive_nested(tmp_path):
+    """
+    Test extracting an archive with many files spread over nested directories.
+    """
+    zip_path = tmp_path / "nested.zip"
+    import zipfile
+    names = [f"{d}/{i}.pb" for d in ["types", "objects", "objects/sub"] for i in range(20)]
+    with zipfile.ZipFile(zip_path, "w") as zf:
+        zf.writestr("relations/", "")
+        for name in names:
+            zf.writestr(name, name)
+
+    extract_dir = tmp_path / "extract"
+    anytype2csv_utils.extract_archive(str(zip_path), str(extract_dir))
+    assert (extract_dir / "relations").is_dir()
+    for name in names:
+        assert (extract_dir / name).read_text() == name
+
 def test_ensure_directories(tmp_path):
     """
     Test that ensure_directories creates csv and data subdirectories.
@@ -82,6 +99,28 @@ def test_load_single_message_from_file(monkeypatch, tmp_path):
     result = anytype2csv_utils.load_single_message_from_file(str(test_file))
     assert isinstance(result, MockSnapshotWithType)
 
+def test_load_name_and_key_from_file(tmp_path):
+    """
+    Test reading the name and key of a snapshot file, and None for a missing file.
+    """
+    from snapshot_pb2 import SnapshotWithType
+    msg = SnapshotWithType()
+    msg.snapshot.data.key = "rel-key"
+    msg.snapshot.data.details.fields["name"].string_value = "My relation"
+    test_file = tmp_path / "rel.pb"
+    test_file.write_bytes(msg.SerializeToString())
+    assert anytype2csv_utils.load_name_and_key_from_file(str(test_file)) == ("My relation", "rel-key")
+    assert anytype2csv_utils.load_name_and_key_from_file(str(tmp_path / "missing.pb")) is None
+
+def test_load_messages_from_files_keeps_order(monkeypatch):
+    """
+    Test that load_messages_from_files returns one result per path, in input order.
+    """
+    monkeypatch.setattr(anytype2csv_utils, "load_single_message_from_file", lambda x: x.upper())
+    paths = [f"file{i}.pb" for i in range(50)]
+    result = anytype2csv_utils.load_messages_from_files(paths)
+    assert result == [p.upper() for p in paths]
+
 def test_read_rel_option_handles_missing(monkeypatch, tmp_path):
     """
     Test that read_rel_option handles missing options and updates the unknown_options dict.
@@ -96,6 +135,67 @@ def test_read_rel_option_handles_missing(monkeypatch, tmp_path):
     assert result == ""
     assert unknown_options["missing"] == 1
 
+def test_read_rel_option_uses_options_index(monkeypatch, tmp_path):
+    """
+    Test that read_rel_option resolves options from the cache index without reading files.
+    """
+    unknown_options = {}
+    my_cache = {"options": {"opt1": "Done"}}
+
+    def fail(x):
+        raise AssertionError("no file should be read")
+    monkeypatch.setattr(anytype2csv_utils, "load_single_message_from_file", fail)
+    assert anytype2csv_utils.read_rel_option("opt1", str(tmp_path), unknown_options, my_cache) == "Done"
+    assert anytype2csv_utils.read_rel_option("opt2", str(tmp_path), unknown_options, my_cache) == ""
+    assert unknown_options == {"opt2": 1}
+
+def test_read_data_dispatches_on_format():
+    """
+    Test that read_data interprets values by relation format and tracks unknown formats.
+    """
+    from google.protobuf.struct_pb2 import Value
+    from models_pb2 import RelationFormat
+    unknown_types = {}
+    assert anytype2csv_utils.read_data(Value(string_value="abc"), RelationFormat.shorttext, "k",
+                                       "", unknown_types, {}, {}) == "abc"
+    assert anytype2csv_utils.read_data(Value(number_value=3), RelationFormat.number, "k",
+                                       "", unknown_types, {}, {}) == 3.0
+    assert anytype2csv_utils.read_data(Value(bool_value=True), RelationFormat.checkbox, "k",
+                                       "", unknown_types, {}, {}) is True
+    assert anytype2csv_utils.read_data(Value(string_value="abc"), None, "k",
+                                       "", unknown_types, {}, {}) == ""
+    assert anytype2csv_utils.read_data(Value(string_value="abc"), -1, "odd",
+                                       "", unknown_types, {}, {}) == ""
+    assert unknown_types == {"odd": 1}
+
+def test_list_pb_files(tmp_path):
+    """
+    Test that list_pb_files returns sorted .pb files only, and nothing for a missing directory.
+    """
+    for name in ["b.pb", "a.pb", "notes.txt"]:
+        (tmp_path / name).write_bytes(b"")
+    (tmp_path / "sub.pb").mkdir()
+    assert anytype2csv_utils.list_pb_files(str(tmp_path)) == [str(tmp_path / "a.pb"), str(tmp_path / "b.pb")]
+    assert anytype2csv_utils.list_pb_files(str(tmp_path / "missing")) == []
+
+def test_read_data_joins_options():
+    """
+    Test that list formats join option names, leaving out unresolved options.
+    """
+    from google.protobuf.struct_pb2 import Value
+    from models_pb2 import RelationFormat
+    fld = Value()
+    fld.list_value.values.add().string_value = "missing"
+    for option in ["x", "missing", "y"]:
+        fld.list_value.values.add().string_value = option
+    unknown_options = {}
+    my_cache = {"options": {"x": "X", "y": "Y"}}
+    assert anytype2csv_utils.read_data(fld, RelationFormat.tag, "k", "", {},
+                                       unknown_options, my_cache) == "X, Y"
+    assert unknown_options == {"missing": 2}
+    assert anytype2csv_utils.read_data(Value(string_value="y"), RelationFormat.object, "k", "", {},
+                                       unknown_options, my_cache) == "Y"
+
 def test_build_cache_empty(tmp_path, monkeypatch):
     """
     Test that build_cache returns empty dicts when no pb files are present.
@@ -103,11 +203,10 @@ def test_build_cache_empty(tmp_path, monkeypatch):
     pbdir = tmp_path / "pbdir"
     for sub in ["types", "relations", "objects"]:
         (pbdir / sub).mkdir(parents=True, exist_ok=True)
-    regex = MagicMock()
-    regex.match.return_value = False
     monkeypatch.setattr(anytype2csv_utils, "load_single_message_from_file", lambda x: None)
-    cache = anytype2csv_utils.build_cache(str(pbdir), regex)
-    assert set(cache.keys()) == {"types", "relations", "objects", "revrel"}
+    cache, messages = anytype2csv_utils.build_cache(str(pbdir))
+    assert set(cache.keys()) == {"types", "relations", "objects", "revrel", "options"}
+    assert messages == []
 
 def test_generate_csv(tmp_path, data_dir):
     os.environ['TZ'] = 'Europe/Brussels'
@@ -147,3 +246,25 @@ def test_generate_csv(tmp_path, data_dir):
                 print(line)
     print("END - Diff files")
     assert filecmp.cmp(csv_out, csv_ref, False)
+
+def test_generate_csv_selected_fields(tmp_path, data_dir):
+    """
+    Test that exporting selected fields gives the matching columns of the full export.
+    """
+    import csv
+    os.environ['TZ'] = 'Europe/Brussels'
+    time.tzset()
+
+    pbfile = tmp_path / "Anytype.ProjectManagement.zip"
+    pbdir = os.path.join(os.path.dirname(pbfile), "Anytype.ProjectManagement")
+    anytype2csv_utils.extract_archive(pbfile, pbdir, False)
+    dump_fields = ["Name", "Tag", "Links", "Unknown field"]
+    csv_out = anytype2csv_utils.build_csv(pbdir, None, dump_fields, debug=False)
+
+    with open(tmp_path / "anytype2csv-output.csv", newline='', encoding='utf-8') as fref:
+        ref = list(csv.DictReader(fref, delimiter='|'))
+    with open(csv_out, newline='', encoding='utf-8') as fcsv:
+        reader = csv.DictReader(fcsv, delimiter='|')
+        out = list(reader)
+    assert reader.fieldnames == ["Links", "Name", "Tag"]
+    assert out == [{k: row[k] for k in reader.fieldnames} for row in ref]